@@ -8,8 +8,7 @@
 import time
 import math
 import numpy as np
-from copy import deepcopy
-from itertools import count
+from itertools import count, product
 from termcolor import colored
 from .utils import get_pose, set_pose, get_movable_joints, \
     set_joint_positions, add_fixed_constraint, enable_real_time, \
@@ -20,10 +19,12 @@ from .utils import get_pose, set_pose, get_movable_joints, \
     INF, Point, inverse_kinematics, pairwise_collision, \
     remove_fixed_constraint, Attachment, get_sample_fn, \
     step_simulation, refine_path, plan_direct_joint_motion, \
-    get_joint_positions, dump_world, wait_if_gui, flatten, \
+    get_joint_positions, dump_world, wait_if_gui, \
     Euler, unit_pose, approximate_as_prism, point_from_pose, \
-    multiply, stable_z, euler_from_quat, plan_joint_motion_interpolation, \
-    inverse_kinematics_tracik, sample_placement_reachable
+    stable_z, plan_joint_motion_interpolation, \
+    inverse_kinematics_tracik, tform_from_pose, \
+    sample_placements_reachable, \
+    pose_from_tform, cached_fn, get_aabb, aabb_overlap, is_circular
 
 from pybullet_tools.ikfast.franka_panda.ik import is_ik_compiled, ikfast_inverse_kinematics
 # TODO: deprecate
@@ -51,16 +52,23 @@ TOOL_FRAMES = {
 
 DEBUG_FAILURE = False
 
+# Storage type of BodyPath waypoints, upcast to float64 when handed to pybullet
+DTYPE = np.float32
+
+# Inverted bounds: fail every interval overlap test, including the union over all waypoints
+EMPTY_AABB = (np.full(3, np.inf), np.full(3, -np.inf))
+
 ##################################################
 
 class BodyPose(object):
-    num = count()
+    __slots__ = ('body', 'pose', 'index')
+    _next_index = count().__next__ # bound once, skips the next() builtin lookup
     def __init__(self, body, pose=None):
         if pose is None:
             pose = get_pose(body)
         self.body = body
         self.pose = pose
-        self.index = next(self.num)
+        self.index = self._next_index()
     @property
     def value(self):
         return self.pose
@@ -74,14 +82,15 @@ class BodyPose(object):
 
 
 class BodyGrasp(object):
-    num = count()
+    __slots__ = ('body', 'grasp_pose', 'approach_pose', 'robot', 'link', 'index')
+    _next_index = count().__next__
     def __init__(self, body, grasp_pose, approach_pose, robot, link):
         self.body = body
         self.grasp_pose = grasp_pose
         self.approach_pose = approach_pose
         self.robot = robot
         self.link = link
-        self.index = next(self.num)
+        self.index = self._next_index()
     @property
     def value(self):
         return self.grasp_pose
@@ -100,7 +109,8 @@ class BodyGrasp(object):
         return 'g{}'.format(index)
 
 class BodyConf(object):
-    num = count()
+    __slots__ = ('body', 'joints', 'configuration', 'index')
+    _next_index = count().__next__
     def __init__(self, body, configuration=None, joints=None):
         if joints is None:
             joints = get_movable_joints(body)
@@ -109,7 +119,7 @@ class BodyConf(object):
         self.body = body
         self.joints = joints
         self.configuration = configuration
-        self.index = next(self.num)
+        self.index = self._next_index()
     @property
     def values(self):
         return self.configuration
@@ -122,32 +132,56 @@ class BodyConf(object):
         return 'q{}'.format(index)
 
 class BodyPath(object):
+    __slots__ = ('body', 'path', 'joints', 'attachments', '_bodies', '_aabbs')
     def __init__(self, body, path, joints=None, attachments=[]):
         if joints is None:
             joints = get_movable_joints(body)
+        if not (isinstance(path, np.ndarray) and (path.dtype == DTYPE)):
+            # views such as path[::-1] are kept as is
+            path = np.array(path, dtype=DTYPE)
+            if path.size == 0:
+                path = path.reshape(0, len(joints))
+        assert (path.ndim == 2) and (path.shape[1] == len(joints)) # (num_waypoints, num_joints)
         self.body = body
         self.path = path
         self.joints = joints
         self.attachments = attachments
+        self._bodies = frozenset([body] + [attachment.body for attachment in attachments])
+        self._aabbs = None
     def bodies(self):
-        return set([self.body] + [attachment.body for attachment in self.attachments])
+        return self._bodies
+    def assign_waypoint(self, i):
+        set_joint_positions(self.body, self.joints, self.path[i].astype(np.float64))
+        for grasp in self.attachments:
+            grasp.assign()
     def iterator(self):
-        # TODO: compute and cache these
-        # TODO: compute bounding boxes as well
-        for i, configuration in enumerate(self.path):
-            set_joint_positions(self.body, self.joints, configuration)
-            for grasp in self.attachments:
-                grasp.assign()
+        for i in range(self.path.shape[0]):
+            self.assign_waypoint(i)
             yield i
+    def get_waypoint_aabbs(self):
+        # body -> (lowers, uppers), the (num_waypoints, 3) AABB bounds of each moving body
+        if self._aabbs is None:
+            bodies = self.bodies()
+            aabbs = {body: [] for body in bodies}
+            for _ in self.iterator():
+                for body in bodies:
+                    aabb = get_aabb(body)
+                    # A body without an AABB is given empty bounds that never overlap
+                    aabbs[body].append(EMPTY_AABB if aabb is None else aabb)
+            self._aabbs = {}
+            for body, body_aabbs in aabbs.items():
+                bounds = np.array(body_aabbs, dtype=np.float64).reshape(-1, 2, 3)
+                self._aabbs[body] = (bounds[:, 0], bounds[:, 1])
+        return self._aabbs
     def control(self, real_time=False, dt=0):
         # TODO: just waypoints
         if real_time:
             enable_real_time()
         else:
             disable_real_time()
+        enable_gravity()
         for values in self.path:
-            for _ in joint_controller(self.body, self.joints, values):
-                enable_gravity()
+            for _ in joint_controller(self.body, self.joints, values.astype(np.float64)):
                 if not real_time:
                     step_simulation()
                 time.sleep(dt)
@@ -157,9 +191,20 @@ class BodyPath(object):
     # def full_path(self, q0=None):
     #     # TODO: could produce sequence of savers
     def refine(self, num_steps=0):
-        return self.__class__(self.body, refine_path(self.body, self.joints, self.path, num_steps), self.joints, self.attachments)
+        if any(is_circular(self.body, joint) for joint in self.joints):
+            # refine_path also wraps the circular joints
+            path = refine_path(self.body, self.joints, self.path, num_steps)
+        else:
+            # Same waypoints as refine_path: num_steps + 1 per segment, excluding its start
+            path = np.linspace(self.path[:-1], self.path[1:], num_steps + 2, axis=1)[:, 1:, :]
+            path = path.reshape(-1, len(self.joints))
+        return self.__class__(self.body, path, self.joints, self.attachments)
     def reverse(self):
-        return self.__class__(self.body, self.path[::-1], self.joints, self.attachments)
+        body_path = self.__class__(self.body, self.path[::-1], self.joints, self.attachments)
+        if self._aabbs is not None:
+            body_path._aabbs = {body: (lowers[::-1], uppers[::-1])
+                                for body, (lowers, uppers) in self._aabbs.items()}
+        return body_path
     def __repr__(self):
         return '{}({},{},{},{})'.format(self.__class__.__name__, self.body, len(self.joints), len(self.path), len(self.attachments))
 
@@ -170,10 +215,13 @@ class ApplyForce(object):
         self.body = body
         self.robot = robot
         self.link = link
+        self._bodies = frozenset([body, robot])
     def bodies(self):
-        return {self.body, self.robot}
+        return self._bodies
     def iterator(self, **kwargs):
         return []
+    def get_waypoint_aabbs(self):
+        return {}
     def refine(self, **kwargs):
         return self
     def __repr__(self):
@@ -193,12 +241,13 @@ class Detach(ApplyForce):
         return Attach(self.body, self.robot, self.link)
 
 class Command(object):
-    num = count()
+    _next_index = count().__next__
     def __init__(self, body_paths):
         self.body_paths = body_paths
-        self.index = next(self.num)
+        self.index = self._next_index()
+        self._bodies = frozenset().union(*(path.bodies() for path in body_paths))
     def bodies(self):
-        return set(flatten(path.bodies() for path in self.body_paths))
+        return self._bodies
     # def full_path(self, q0=None):
     #     if q0 is None:
     #         q0 = Conf(self.tree)
@@ -235,33 +284,48 @@ def get_tool_link(robot):
     return link_from_name(robot, TOOL_FRAMES[get_body_name(robot)])
     
 
+def tform_from_point(point):
+    tform = np.eye(4)
+    tform[:3, 3] = point
+    return tform
+
+def z_rotation_tforms(yaws):
+    # (k, 4, 4) stack of rotations about the z axis
+    yaws = np.asarray(yaws, dtype=np.float64)
+    tforms = np.tile(np.eye(4), (len(yaws), 1, 1))
+    tforms[:, 0, 0] = tforms[:, 1, 1] = np.cos(yaws)
+    tforms[:, 1, 0] = np.sin(yaws)
+    tforms[:, 0, 1] = -tforms[:, 1, 0]
+    return tforms
+
+REFLECT_Z = np.diag([-1., 1., -1., 1.]) # Pose(euler=[0, math.pi, 0])
+
 def get_top_grasps(body, under=False, tool_pose=TOOL_POSE, body_pose=unit_pose(),
                    max_width=MAX_GRASP_WIDTH, grasp_length=GRASP_LENGTH):
     # TODO: rename the box grasps
     center, (w, l, h) = approximate_as_prism(body, body_pose=body_pose)
-    reflect_z = Pose(euler=[0, math.pi, 0])
-    translate_z = Pose(point=[0, 0, h / 2 - grasp_length])
-    translate_center = Pose(point=point_from_pose(body_pose)-center)
-    grasps = []
+    yaws = []
     if w <= max_width:
-        for i in range(1 + under):
-            rotate_z = Pose(euler=[0, 0, math.pi / 2 + i * math.pi])
-            grasps += [multiply(tool_pose, translate_z, rotate_z,
-                                reflect_z, translate_center, body_pose)]
+        yaws += [math.pi / 2 + i * math.pi for i in range(1 + under)]
     if l <= max_width:
-        for i in range(1 + under):
-            rotate_z = Pose(euler=[0, 0, i * math.pi])
-            grasps += [multiply(tool_pose, translate_z, rotate_z,
-                                reflect_z, translate_center, body_pose)]
-    return grasps
+        yaws += [i * math.pi for i in range(1 + under)]
+    if not yaws:
+        return []
+    # tool_pose * translate_z * rotate_z * reflect_z * translate_center * body_pose
+    prefix = np.dot(tform_from_pose(tool_pose), tform_from_point([0, 0, h / 2 - grasp_length]))
+    suffix = np.linalg.multi_dot([REFLECT_Z, tform_from_point(np.subtract(point_from_pose(body_pose), center)),
+                                  tform_from_pose(body_pose)])
+    tforms = np.matmul(np.matmul(prefix, z_rotation_tforms(yaws)), suffix)
+    return [pose_from_tform(tform) for tform in tforms]
 
 def get_grasp_gen(robot, grasp_name='top', verbose=False):
     if verbose:
         print(colored('\n Running get_grasp_gen function \n', 'red'))
     grasp_info = GRASP_INFO[grasp_name]
     tool_link = get_tool_link(robot)
+    get_grasps = cached_fn(grasp_info.get_grasps) # grasps are in the body frame
     def gen(body, verbose=verbose):
-        grasp_poses = grasp_info.get_grasps(body)
+        grasp_poses = get_grasps(body)
         # TODO: continuous set of grasps
         for grasp_pose in grasp_poses:
             body_grasp = BodyGrasp(body, grasp_pose, grasp_info.approach_pose, robot, tool_link)
@@ -272,18 +336,20 @@ def get_grasp_gen(robot, grasp_name='top', verbose=False):
 
 
 def get_stable_gen(fixed=[], verbose=False, reach_range=(0.25, 0.5),
-                   reach_theta=(-np.pi*0.75, np.pi*0.75)):
+                   reach_theta=(-np.pi*0.75, np.pi*0.75), prefetch=32):
     if verbose:
         print(colored('\n Running get_stable_gen function \n', 'red'))
     def gen(body, surface, verbose=verbose):
         while True:
-            pose = sample_placement_reachable(body, surface, 
-                                              reach_range=reach_range, 
-                                              reach_theta=reach_theta)
-            body_pose = BodyPose(body, pose)
-            if verbose:
-                print(colored(f'\n Sampled Pose {body_pose.value} \n', 'green'))    
-            yield (body_pose,)
+            # sample prefetch poses at once, downstream tests often reject many in a row
+            poses = sample_placements_reachable(body, surface, num_samples=prefetch,
+                                                reach_range=reach_range,
+                                                reach_theta=reach_theta)
+            for pose in poses:
+                body_pose = BodyPose(body, pose)
+                if verbose:
+                    print(colored(f'\n Sampled Pose {body_pose.value} \n', 'green'))    
+                yield (body_pose,)
     return gen
 
 # def get_stable_gen2(fixed=[], verbose=False, reach_range=(0.25, 0.5),
@@ -307,34 +373,65 @@ def get_stack_gen(verbose=False):
     def gen(body1, body2, pose, verbose=verbose):
         point = Point(x=pose.value[0][0], y=pose.value[0][1], 
               z=stable_z(body1, body2))
-        roll, pitch, yaw = euler_from_quat(pose.value[1])
-        euler = Euler(roll=roll, pitch=pitch, yaw=yaw)
-        # set_pose(body1, Pose(point=point, euler=euler))
-        body_pose = BodyPose(body1, 
-                             Pose(point=point, euler=euler))
+        # keeps the orientation of pose, no need for a quat -> euler -> quat round trip
+        # set_pose(body1, (point, pose.value[1]))
+        body_pose = BodyPose(body1, (point, pose.value[1]))
         if verbose:
             print(colored(f'\n Stack Pose {body_pose.value} \n', 'green'))
         yield (body_pose,)
     return gen
 
 # ==================================================
+class MRUList(object):
+    # Moves the last hit to the front, so that clustered hits short-circuit on the first test
+    def __init__(self, items):
+        self.items = list(items)
+    def find(self, test):
+        for i, item in enumerate(self.items):
+            if test(item):
+                if i != 0:
+                    self.items.insert(0, self.items.pop(i))
+                return item
+        return None
+
+def get_mru_collision_fn(bodies, obstacles):
+    # Tests the current simulator state, starting from the (body, obstacle) pair that last collided
+    pairs = MRUList(product(bodies, obstacles))
+    def fn():
+        return pairs.find(lambda pair: pairwise_collision(*pair)) is not None
+    return fn
+
+class SeededIKSolver(object):
+    def __init__(self, robot, num_attempts=10):
+        self.robot = robot
+        self.num_attempts = num_attempts
+        self.joints = get_movable_joints(robot)
+        self.sample_fn = get_sample_fn(robot, self.joints)
+    def solve(self, link, approach_pose, gripper_pose, obstacles=[]):
+        # Yields every (q_approach, q_grasp) pair that is collision-free
+        collision_fn = get_mru_collision_fn([self.robot], obstacles)
+        for _ in range(self.num_attempts):
+            seed = self.sample_fn()
+            set_joint_positions(self.robot, self.joints, seed) # Random seed
+            q_approach = inverse_kinematics(self.robot, link, approach_pose)
+            # inverse_kinematics leaves the robot at its solution
+            if (q_approach is None) or collision_fn():
+                continue
+            q_grasp = inverse_kinematics(self.robot, link, gripper_pose)
+            if (q_grasp is None) or collision_fn():
+                continue
+            yield q_approach, q_grasp
+
 def get_ik_fn(robot, fixed=[], teleport=False, num_attempts=10):
-    movable_joints = get_movable_joints(robot)
-    sample_fn = get_sample_fn(robot, movable_joints)
+    ik_solver = SeededIKSolver(robot, num_attempts=num_attempts)
+    fixed = tuple(fixed)
     def fn(body, pose, grasp):
-        obstacles = [body] + fixed
+        obstacles = (body,) + fixed
         gripper_pose = end_effector_from_body(pose.pose, grasp.grasp_pose)
         approach_pose = approach_from_grasp(grasp.approach_pose, gripper_pose)
-        for _ in range(num_attempts):
-            set_joint_positions(robot, movable_joints, sample_fn()) # Random seed
-            # TODO: multiple attempts?
-            q_approach = inverse_kinematics(robot, grasp.link, approach_pose)
-            if (q_approach is None) or any(pairwise_collision(robot, b) for b in obstacles):
-                continue
+        ik_pairs = ik_solver.solve(grasp.link, approach_pose, gripper_pose, obstacles=obstacles)
+        for q_approach, q_grasp in ik_pairs:
             conf = BodyConf(robot, q_approach)
-            q_grasp = inverse_kinematics(robot, grasp.link, gripper_pose)
-            if (q_grasp is None) or any(pairwise_collision(robot, b) for b in obstacles):
-                continue
             if teleport:
                 path = [q_approach, q_grasp]
             else:
@@ -358,10 +455,10 @@ def get_robots_ik_fn(fixed=[], teleport=False, num_attempts=10, verbose=False):
     # TODO this ik function does not work for the panda robot
     if verbose:
         print(colored('\n Running get_robots_ik_fn function \n', 'red'))
+    last_grasp_confs = {} # robot -> last q_grasp, seeds the next approach
+    fixed = tuple(fixed)
     def fn(robot, body, pose, grasp, verbose=verbose):
-        movable_joints = get_movable_joints(robot)
-        sample_fn = get_sample_fn(robot, movable_joints)
-        obstacles = [body] + fixed # not collide with body
+        obstacles = (body,) + fixed # not collide with body
         # grasp.grasp pose indicates body's pose in gripper frame
         gripper_pose = end_effector_from_body(pose.pose, grasp.grasp_pose)
         approach_pose = approach_from_grasp(grasp.approach_pose, gripper_pose)
@@ -369,13 +466,14 @@ def get_robots_ik_fn(fixed=[], teleport=False, num_attempts=10, verbose=False):
         for _ in range(num_attempts):
             # set_joint_positions(robot, movable_joints, sample_fn()) # Random seed
             # TODO: multiple attempts?
-            q_approach = inverse_kinematics_tracik(robot, grasp.link, approach_pose)
+            q_approach = inverse_kinematics_tracik(robot, grasp.link, approach_pose,
+                                                   seed=last_grasp_confs.get(robot))
             # if (q_approach is None) or any(pairwise_collision(robot, b) for b in obstacles):
             #     continue
             if q_approach is None:
                 continue
             conf_approach = BodyConf(robot, q_approach)
-            q_grasp = inverse_kinematics_tracik(robot, grasp.link, gripper_pose)
+            q_grasp = inverse_kinematics_tracik(robot, grasp.link, gripper_pose, seed=q_approach)
             # if (q_grasp is None) or any(pairwise_collision(robot, b) for b in obstacles):
             #     continue
             if q_grasp is None:
@@ -399,6 +497,7 @@ def get_robots_ik_fn(fixed=[], teleport=False, num_attempts=10, verbose=False):
                 if DEBUG_FAILURE: wait_if_gui('Approach motion failed')
                 continue
             else:
+                last_grasp_confs[robot] = q_grasp
                 if verbose:
                     print(colored(f'\n Robot approach conf: {conf_approach} \n', 'green'))
                     print(colored(f'\n Robot grasp conf: {conf_grasp} \n', 'green'))
@@ -407,22 +506,35 @@ def get_robots_ik_fn(fixed=[], teleport=False, num_attempts=10, verbose=False):
     return fn
 ##################################################
 
+def _assign_atpose(args):
+    o, p = args
+    p.assign()
+    return o, None
+
+def _assign_athandpose(args):
+    o, g = args[1], args[2]
+    g.assign()
+    return None, g
+
+# fluent name -> handler(args) returning (obstacle, grasp), either may be None
+_FLUENT_HANDLERS = {
+    'atpose': _assign_atpose,
+    'athandpose': _assign_athandpose,
+}
+
 def assign_fluent_state(fluents):
     obstacles = []
     grasp = None
     for fluent in fluents:
-        name, args = fluent[0], fluent[1:]
-        if name == 'atpose':
-            o, p = args
-            obstacles.append(o)
-            p.assign()
-        elif name == 'athandpose':
-            o, g = args[1], args[2]
-            grasp = g
-            g.assign()
-        else:
+        handler = _FLUENT_HANDLERS.get(fluent[0])
+        if handler is None:
             # raise ValueError(name)
             continue
+        obstacle, g = handler(fluent[1:])
+        if obstacle is not None:
+            obstacles.append(obstacle)
+        if g is not None:
+            grasp = g
     return obstacles, grasp
 
 def get_free_motion_gen(robot, fixed=[], verbose=False,
@@ -503,18 +615,40 @@ def get_motion_gen(fixed=[], verbose=False,
 ##################################################
 
 def get_movable_collision_test():
+    # moving bodies -> MRUList of the moving bodies, shared across calls so that
+    # the one that last hit an obstacle (e.g. the grasped block) is tested first
+    moving_orders = {}
     def test(command, body, pose):
         if body in command.bodies():
             return False
         pose.assign()
+        body_aabb = get_aabb(body)
+        if body_aabb is None:
+            return False
+        body_lower, body_upper = map(np.array, body_aabb)
         for path in command.body_paths:
             moving = path.bodies()
             if body in moving:
                 # TODO: cannot collide with itself
                 continue
-            for _ in path.iterator():
+            waypoint_aabbs = path.get_waypoint_aabbs()
+            if not waypoint_aabbs:
+                continue
+            # Broad phase: waypoints at which some moving AABB overlaps the body AABB
+            candidates = np.zeros(len(path.path), dtype=bool)
+            for mov in moving:
+                lowers, uppers = waypoint_aabbs[mov]
+                if (len(lowers) == 0) or not aabb_overlap((lowers.min(axis=0), uppers.max(axis=0)),
+                                                          (body_lower, body_upper)):
+                    continue
+                candidates |= np.all((uppers >= body_lower) & (lowers <= body_upper), axis=1)
+            if moving not in moving_orders:
+                moving_orders[moving] = MRUList(moving)
+            order = moving_orders[moving]
+            for i in np.flatnonzero(candidates):
                 # TODO: could shuffle this
-                if any(pairwise_collision(mov, body) for mov in moving):
+                path.assign_waypoint(i)
+                if order.find(lambda mov: pairwise_collision(mov, body)) is not None:
                     if DEBUG_FAILURE: wait_if_gui('Movable collision')
                     return True
         return False
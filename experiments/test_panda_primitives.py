@@ -0,0 +1,71 @@
+# -----------------------------------------------------------------------------
+# SPDX-License-Identifier: GPL-3.0-only
+# This file is part of the LogicLfD project.
+# Copyright (c) 2024 Idiap Research Institute <contact@idiap.ch>
+# Contributor: Yan Zhang <yan.zhang@idiap.ch>
+# -----------------------------------------------------------------------------
+
+"""
+This file checks the BodyPath waypoint storage of panda_primitives.py:
+the float32 (num_waypoints, num_joints) layout, reverse and the np.linspace refine
+against refine_path
+"""
+
+import numpy as np
+import pytest
+from config import PANDA_ARM_URDF
+
+pytest.importorskip('pybullet')
+pytest.importorskip('pybullet_tools') # env-thirdparty/pybullet_planning submodule
+from experiments.utils import connect, disconnect, load_pybullet, \
+    get_movable_joints, is_circular, refine_path
+from experiments.panda_primitives import BodyPath, DTYPE
+
+NUM_WAYPOINTS = [0, 1, 2, 5]
+
+@pytest.fixture(scope='module')
+def robot():
+    connect(use_gui=False)
+    robot = load_pybullet(PANDA_ARM_URDF, fixed_base=True)
+    yield robot
+    disconnect()
+
+def random_path(robot, num_waypoints, seed=0):
+    joints = get_movable_joints(robot)
+    return np.random.RandomState(seed).uniform(-1., 1., size=(num_waypoints, len(joints)))
+
+@pytest.mark.parametrize('num_waypoints', NUM_WAYPOINTS)
+def test_storage(robot, num_waypoints):
+    joints = get_movable_joints(robot)
+    path = BodyPath(robot, random_path(robot, num_waypoints).tolist(), joints)
+    assert path.path.dtype == DTYPE
+    assert path.path.shape == (num_waypoints, len(joints))
+    reversed_path = path.reverse()
+    assert reversed_path.path.dtype == DTYPE
+    assert reversed_path.path.shape == (num_waypoints, len(joints))
+
+def test_storage_shape_mismatch(robot):
+    joints = get_movable_joints(robot)
+    with pytest.raises(AssertionError):
+        BodyPath(robot, np.zeros(len(joints)), joints)
+    with pytest.raises(AssertionError):
+        BodyPath(robot, np.zeros((2, len(joints) + 1)), joints)
+
+@pytest.mark.parametrize('num_waypoints', NUM_WAYPOINTS)
+def test_reverse_round_trip(robot, num_waypoints):
+    joints = get_movable_joints(robot)
+    path = BodyPath(robot, random_path(robot, num_waypoints), joints)
+    reversed_path = path.reverse()
+    assert np.array_equal(reversed_path.path, path.path[::-1])
+    assert np.array_equal(reversed_path.reverse().path, path.path)
+
+@pytest.mark.parametrize('num_waypoints', NUM_WAYPOINTS)
+@pytest.mark.parametrize('num_steps', [0, 1, 3])
+def test_refine(robot, num_waypoints, num_steps):
+    joints = get_movable_joints(robot)
+    assert not any(is_circular(robot, joint) for joint in joints)
+    path = BodyPath(robot, random_path(robot, num_waypoints), joints)
+    refined_path = path.refine(num_steps=num_steps)
+    expected = np.array(refine_path(robot, joints, path.path, num_steps), dtype=DTYPE).reshape(-1, len(joints))
+    assert refined_path.path.shape == (max(num_waypoints - 1, 0) * (num_steps + 1), len(joints))
+    assert np.allclose(refined_path.path, expected, atol=1e-6)
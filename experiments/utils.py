@@ -4488,6 +4488,22 @@ def sample_placement_reachable(top_body, bottom_body, bottom_link=None,
         return pose
     return None
 
+def sample_placements_reachable(top_body, bottom_body, num_samples=1,
+                                top_pose=unit_pose(), **kwargs):
+    # Batched sample_placement_reachable, the body geometry is only queried once
+    reach_range = kwargs.get("reach_range", (0.25, 1.0))
+    reach_theta = kwargs.get("reach_theta", (-np.pi, np.pi))
+
+    center, extent = get_center_extent(top_body)
+    z = stable_z(top_body, bottom_body)
+    radii = np.random.uniform(*reach_range, size=num_samples)
+    thetas = np.random.uniform(reach_theta[0], reach_theta[1], size=num_samples)
+    points = np.column_stack([radii*np.cos(thetas), radii*np.sin(thetas),
+                              np.full(num_samples, z)])
+    points += (get_point(top_body) - center) + point_from_pose(top_pose)
+    # multiply(Pose(point, Euler()), top_pose) with an identity rotation
+    return [(point, quat_from_pose(top_pose)) for point in points]
+
 def sample_placement_reachable_pos(top_body, bottom_body, 
                                 max_attempts=50, 
                                 **kwargs):
@@ -5028,20 +5044,33 @@ def inverse_kinematics(robot, link, target_pose,
         return None
     return kinematic_conf
 
+TRACIK_SOLVER_CACHE = {}
+
+def get_tracik_solver(urdf=PANDA_ARM_URDF, base_link="panda_link0", tool_link="tool_link"):
+    # Parsing the URDF and building the KDL chain is the expensive part, do it once per chain
+    key = (urdf, base_link, tool_link)
+    if key not in TRACIK_SOLVER_CACHE:
+        from tracikpy import TracIKSolver
+        TRACIK_SOLVER_CACHE[key] = TracIKSolver(urdf, base_link, tool_link)
+    return TRACIK_SOLVER_CACHE[key]
+
 def inverse_kinematics_tracik(robot, link, target_pose,
                               max_iterations=200, max_time=INF,
-                              custom_limits={}, **kwargs):
+                              custom_limits={}, seed=None, **kwargs):
     base_link = "panda_link0"
     tool_link = "tool_link"
-    ik_sover = TracIKSolver(PANDA_ARM_URDF,
-                            base_link,
-                            tool_link)
+    ik_sover = get_tracik_solver(PANDA_ARM_URDF,
+                                 base_link,
+                                 tool_link)
     movable_joints = get_movable_joints(robot)
     target_matrix = np.eye((4))
     target_matrix[:3, 3] = target_pose[0]
     target_matrix[:3, :3] = matrix_from_quat(target_pose[1])
-    for _ in irange(max_iterations):
-        qinit = get_joint_positions(robot, movable_joints)[:7]
+    for iteration in irange(max_iterations):
+        if (iteration == 0) and (seed is not None):
+            qinit = seed[:7] # warm start, e.g. from a nearby solution
+        else:
+            qinit = get_joint_positions(robot, movable_joints)[:7]
         kinematic_conf = ik_sover.ik(target_matrix,
                                     qinit=qinit)
         if kinematic_conf is None: